@@ -1,9 +1,20 @@
 # First script: create_all_consolidated_data.py
+import io
 import os
-import gzip
+import re
 import json
 import glob
+import shutil
 import argparse
+import tempfile
+import subprocess
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Column mapping definitions
 COLUMN_MAPPINGS = {
@@ -19,56 +30,136 @@ COLUMN_MAPPINGS = {
     }
 }
 
-def process_gz_file(file_path, software_type):
-    """Process a gzipped file based on its software type."""
-    snp_data = {}
+# Chromosome labels become part of file names, so only plain ones are accepted
+# (e.g. 1, chrX, GL000192.1): no path separators, no leading dot, not empty
+CHROMOSOME_LABEL = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9_.-]*')
+
+def build_decompress_cmd(file_path):
+    """Return the argv that writes the decompressed file_path to stdout."""
+    # Prefer multithreaded decompressors over zcat when installed; thread counts
+    # stay small because one of these runs per worker process
+    if shutil.which('rapidgzip'):
+        return ['rapidgzip', '-d', '-c', '-P', '4', file_path]
+    if shutil.which('pigz'):
+        return ['pigz', '-dc', '-p', '4', file_path]
+    return ['zcat', file_path]
+
+def build_compress_cmd():
+    """Return the argv of the fastest available gzip compressor (stdin to stdout)."""
+    # Level 1 roughly halves compression CPU for a small size cost; like the
+    # decompressor, one of these runs per worker process and chromosome, so
+    # pigz gets only a couple of threads
+    if shutil.which('pigz'):
+        return ['pigz', '-p', '2', '-1']
+    return ['gzip', '-1']
+
+def dump_record(record):
+    """Serialize one record as a newline-terminated NDJSON line."""
+    if orjson is not None:
+        return orjson.dumps(record) + b'\n'
+    return json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+
+def process_gz_file(file_path, software_type, shard_prefix):
+    """Process a gzipped file based on its software type.
+
+    Each SNP is written as soon as it is parsed to the compressor of its
+    chromosome's gzipped shard, {shard_prefix}.{chromosome}.ndjson.gz, one
+    {snp_id: {phenotype: {cohort: snp_info}}} record per line.
+    Rows whose chromosome label is not a safe file name part are skipped.
+    Returns a {chromosome: records written} dict.
+    """
+    records = {}
     mapping = COLUMN_MAPPINGS[software_type]
     
+    # Only the mapped columns are kept by cut, so re-index the mapping onto them
+    columns = sorted(set(mapping.values()))
+    mapping = {key: columns.index(col) for key, col in mapping.items()}
+    cut_fields = ','.join(str(col + 1) for col in columns)
+    max_idx = max(mapping.values())
+    min_fields = max_idx + 1
+    # Bind column indices to locals so the per-line loop does no dict lookups
+    (i_id, i_chr, i_pos, i_ref, i_alt, i_beta, i_se,
+     i_pval, i_aaf, i_n, i_nstudy) = (mapping[key] for key in (
+        'id', 'chr', 'pos', 'ref', 'alt', 'beta', 'se', 'pval', 'aaf', 'n', 'n_study'))
+    
     filename = os.path.basename(file_path)
     phenotype = filename.split('.')[0]
     cohort = filename.split('.')[1]
     
     print(f"Processing {phenotype} - {cohort} ({software_type})")
     
-    with gzip.open(file_path, 'rt') as f:
-        header = next(f)
-        for line in f:
-            fields = line.strip().split('\t')
-            if len(fields) < max(mapping.values()) + 1:
-                continue
-            
-            try:
-                snp_info = {
-                    'chromosome': fields[mapping['chr']],
-                    'position': fields[mapping['pos']],
-                    'ref_allele': fields[mapping['ref']],
-                    'alt_allele': fields[mapping['alt']],
-                    'beta': fields[mapping['beta']],
-                    'se': fields[mapping['se']],
-                    'p_value': fields[mapping['pval']],
-                    'aaf': fields[mapping['aaf']],
-                    'n': fields[mapping['n']],
-                    'n_study': fields[mapping['n_study']]
-                }
+    # Decompress and select columns in child processes so native code runs alongside the parser
+    decompress = subprocess.Popen(build_decompress_cmd(file_path), stdout=subprocess.PIPE)
+    proc = subprocess.Popen(['cut', '-f', cut_fields], stdin=decompress.stdout,
+                            stdout=subprocess.PIPE, bufsize=1 << 20)
+    decompress.stdout.close()
+    skipped = 0
+    compressors = []
+    try:
+        with ExitStack() as stack:
+            writers = {}  # chromosome -> shard writer, or None for an invalid label
+            f = stack.enter_context(io.TextIOWrapper(proc.stdout, encoding='utf-8', newline='\n'))
+            header = next(f)
+            for line in f:
+                # Drop only the line ending (strip() would also eat empty trailing
+                # fields) and stop splitting after the last mapped column
+                fields = line.rstrip('\n').split('\t', max_idx)
+                if len(fields) < min_fields:
+                    continue
                 
-                snp_id = fields[mapping['id']]
+                # The length check above already rules out an IndexError here
+                chromosome = fields[i_chr]
+                if chromosome not in writers:
+                    if CHROMOSOME_LABEL.fullmatch(chromosome):
+                        # Records are compressed as they are written; leaving
+                        # the stack closes the compressor's stdin and waits for it
+                        with open(f'{shard_prefix}.{chromosome}.ndjson.gz', 'wb') as shard:
+                            compress = stack.enter_context(subprocess.Popen(
+                                build_compress_cmd(), stdin=subprocess.PIPE, stdout=shard, bufsize=1 << 20))
+                        compressors.append(compress)
+                        writers[chromosome] = compress.stdin
+                        records[chromosome] = 0
+                    else:
+                        writers[chromosome] = None
+                writer = writers[chromosome]
+                if writer is None:
+                    skipped += 1
+                    continue
                 
-                if snp_id not in snp_data:
-                    snp_data[snp_id] = {}
-                
-                if phenotype not in snp_data[snp_id]:
-                    snp_data[snp_id][phenotype] = {}
+                snp_info = {
+                    'chromosome': chromosome,
+                    'position': fields[i_pos],
+                    'ref_allele': fields[i_ref],
+                    'alt_allele': fields[i_alt],
+                    'beta': fields[i_beta],
+                    'se': fields[i_se],
+                    'p_value': fields[i_pval],
+                    'aaf': fields[i_aaf],
+                    'n': fields[i_n],
+                    'n_study': fields[i_nstudy]
+                }
                 
-                snp_data[snp_id][phenotype][cohort] = snp_info
+                snp_id = fields[i_id]
                 
-            except (IndexError, ValueError) as e:
-                print(f"Error processing line in {file_path}: {str(e)}")
-                continue
+                writer.write(dump_record({snp_id: {phenotype: {cohort: snp_info}}}))
+                records[chromosome] += 1
+    except BaseException:
+        # Reap both children, so a failed file leaves no processes behind in the pool worker
+        for step in (decompress, proc):
+            step.kill()
+            step.wait()
+        raise
+    
+    for step in (decompress, proc, *compressors):
+        if step.wait() != 0:
+            raise subprocess.CalledProcessError(step.returncode, step.args)
     
-    return snp_data
+    if skipped:
+        print(f"Skipped {skipped} lines with an invalid chromosome label in {file_path}")
+    
+    return records
 
 def process_software_type(input_dir, output_dir, software_type):
-    consolidated_data = {}
     pattern = os.path.join(input_dir, f"*.{software_type}.sumstats.txt.gz")
     gz_files = glob.glob(pattern)
     
@@ -78,19 +169,43 @@ def process_software_type(input_dir, output_dir, software_type):
         
     print(f"\nProcessing {software_type} files...")
     
-    for file_path in gz_files:
-        try:
-            file_data = process_gz_file(file_path, software_type)
-            consolidated_data.update(file_data)
-        except Exception as e:
-            print(f"Error processing {file_path}: {str(e)}")
+    # Each worker streams one input file through a compressor per chromosome
+    # into its own gzipped shards; the shards of each chromosome are then
+    # concatenated, as gzip members, into that chromosome's output file
+    shard_dir = tempfile.mkdtemp(prefix=f'.{software_type}_shards_', dir=output_dir)
+    shard_prefixes = [os.path.join(shard_dir, str(index)) for index in range(len(gz_files))]
+    
+    total_records = 0
+    chromosome_shards = {}
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(process_gz_file, file_path, software_type, shard_prefix)
+                   for file_path, shard_prefix in zip(gz_files, shard_prefixes)]
+        for file_path, shard_prefix, future in zip(gz_files, shard_prefixes, futures):
+            try:
+                records = future.result()
+            except Exception as e:
+                print(f"Error processing {file_path}: {str(e)}")
+                continue
+            total_records += sum(records.values())
+            for chromosome in records:
+                chromosome_shards.setdefault(chromosome, []).append(
+                    f'{shard_prefix}.{chromosome}.ndjson.gz')
 
-    output_file = os.path.join(output_dir, f'consolidated_snp_data_{software_type}.json.gz')
-    with gzip.open(output_file, 'wt') as f:
-        json.dump(consolidated_data, f)
+    # Remove every chromosome file of an earlier run first, so none is left
+    # behind for a chromosome that is no longer in the data
+    for stale_file in glob.glob(os.path.join(output_dir, f'consolidated_snp_data_{software_type}.*.ndjson.gz')):
+        os.remove(stale_file)
+    
+    for chromosome, shard_files in chromosome_shards.items():
+        output_file = os.path.join(output_dir, f'consolidated_snp_data_{software_type}.{chromosome}.ndjson.gz')
+        with open(output_file, 'wb') as f:
+            for shard_file in shard_files:
+                with open(shard_file, 'rb') as shard:
+                    shutil.copyfileobj(shard, f, 1 << 20)
+    shutil.rmtree(shard_dir)
 
-    print(f"{software_type} data saved to {output_file}")
-    print(f"Total SNPs processed for {software_type}: {len(consolidated_data)}")
+    print(f"{software_type} data saved to {len(chromosome_shards)} chromosome files in {output_dir}")
+    print(f"Total SNP records processed for {software_type}: {total_records}")
 
 def main():
     parser = argparse.ArgumentParser(description='Process GWAS summary statistics files for both MRMEGA and GWAMA.')
@@ -1,126 +1,176 @@
 import subprocess
 import os
+import shlex
+import shutil
 import base64
 import glob
 import argparse
 
-def create_tabix_file(input_file, output_file, pval_min=None, pval_max=None):
-    # Add counters for debugging
-    total_lines = 0
-    filtered_lines = 0
-    error_lines = 0
-    
-    # Step 1: First count lines in input file
-    print(f"Counting lines in input file {input_file}...")
-    if input_file.endswith('.gz'):
-        wc_cmd = f"gunzip -c {input_file} | wc -l"
-    else:
-        wc_cmd = f"wc -l < {input_file}"
-    
-    try:
-        total_input_lines = int(subprocess.check_output(wc_cmd, shell=True).decode().strip())
-        print(f"Total input lines: {total_input_lines}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error counting input lines: {e}")
-        raise
+# Column mappings (same as the other scripts)
+COLUMN_MAPPINGS = {
+    'mrmega': {
+        'id': 0, 'chr': 1, 'pos': 2, 'ref': 3, 'alt': 4,
+        'beta': 5, 'se': 6, 'pval': 7, 'aaf': 12,
+        'n': 16, 'n_study': 18
+    },
+    'gwama': {
+        'id': 0, 'chr': 1, 'pos': 2, 'ref': 3, 'alt': 4,
+        'beta': 5, 'se': 6, 'pval': 7, 'aaf': 12,
+        'n': 16, 'n_study': 18
+    }
+}
+
+# mawk's bytecode interpreter scans and parses fields several times faster than gawk
+AWK = 'mawk' if shutil.which('mawk') else 'awk'
 
-    # Step 2: Sort the input file
-    sorted_file = f"{output_file}.sorted"
-    filtered_file = f"{output_file}.filtered"
-    print(f"Sorting data for {output_file}...")
+# Keeps the header plus every row whose P column ($pcol) is a valid p-value
+# within [pmin, pmax]; filtering statistics, naming what was read as $source,
+# are reported on stderr because stdout carries the data on to bgzip
+PVAL_FILTER_AWK = r'''
+function reject(msg) {
+    errors++
+    if (errors <= 5) printf "Error at line %d: %s\n", NR - 1, msg > "/dev/stderr"
+}
+NR == 1 { print; next }
+{ total++ }
+NF < pcol { reject("only " NF " fields"); next }
+{ p = $pcol }
+p !~ /^[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][-+]?[0-9]+)?$/ { reject("invalid p-value " p); next }
+p + 0 < 0 || p + 0 > 1 { reject("invalid p-value " p); next }
+(pmin == "" || p + 0 >= pmin + 0) && (pmax == "" || p + 0 <= pmax + 0) { print; kept++ }
+END {
+    printf "Total %s lines: %d\n", source, NR > "/dev/stderr"
+    printf "\nFiltering Statistics:\n" > "/dev/stderr"
+    printf "Total lines processed: %d\n", total > "/dev/stderr"
+    printf "Lines after filtering: %d\n", kept + 1 > "/dev/stderr"
+    printf "Error lines: %d\n", errors > "/dev/stderr"
+}
+'''
+
+def build_decompress_cmd(input_file):
+    """Return a shell command that writes the decompressed input_file to stdout."""
+    quoted_input = shlex.quote(input_file)
+    # Prefer multithreaded decompressors over single-threaded gunzip when installed
+    if shutil.which('rapidgzip'):
+        return f"rapidgzip -d -c -P {os.cpu_count()} {quoted_input}"
+    if shutil.which('pigz'):
+        return f"pigz -dc -p 4 {quoted_input}"
+    return f"gunzip -c {quoted_input}"
+
+def build_sort_cmd(tmp_dir, mapping):
+    """Return the GNU sort command ordering rows by the mapped CHR, POS, and P columns."""
+    # The C locale skips locale-aware collation, which is far slower and not needed here
+    sort_opts = [f"--parallel={os.cpu_count()}", "--buffer-size=2G", f"-T {shlex.quote(tmp_dir)}"]
+    if shutil.which('zstd'):
+        # Compress spill files to cut temporary disk IO on inputs larger than the buffer
+        sort_opts.append("--compress-program=zstd")
+    chr_col, pos_col, pval_col = (mapping[key] + 1 for key in ('chr', 'pos', 'pval'))
+    sort_keys = f"-k{chr_col},{chr_col}V -k{pos_col},{pos_col}n -k{pval_col},{pval_col}n"
+    return f"LC_ALL=C sort {' '.join(sort_opts)} {sort_keys}"
+
+def encode_base64_file(path, chunk_size=3 * 1024 * 1024):
+    """Stream path into a base64 sidecar file (path + '.b64') and return the sidecar path."""
+    encoded_path = f"{path}.b64"
+    # chunk_size is a multiple of 3, so encoded chunks concatenate without inner padding
+    with open(path, 'rb') as src, open(encoded_path, 'wb') as dst:
+        while chunk := src.read(chunk_size):
+            dst.write(base64.b64encode(chunk))
+    return encoded_path
+
+def pval_range_contains(outer, inner):
+    """Return True if every p-value in the inner (min, max) range lies in the outer one."""
+    (outer_min, outer_max), (inner_min, inner_max) = outer, inner
+    return ((outer_min is None or (inner_min is not None and inner_min >= outer_min)) and
+            (outer_max is None or (inner_max is not None and inner_max <= outer_max)))
+
+def create_tabix_file(input_file, output_file, software_type, pval_min=None, pval_max=None, presorted=False,
+                      base64_sidecars=False):
+    mapping = COLUMN_MAPPINGS[software_type]
+    
+    # Sort, filter and bgzip in one pipeline, so no intermediate sorted/filtered
+    # files are written and re-read; the input line count also comes from the
+    # filter, rather than from a separate decompression pass
+    output_gz_file = f"{output_file}.gz"
+    action = "Filtering" if presorted else "Sorting and filtering"
+    print(f"{action} data with p-value in range {pval_min} to {pval_max} into {output_gz_file}...")
 
-    # Modified sort command to sort by CHR, POS, and P columns (2, 3, and 8)
-    if input_file.endswith('.gz'):
-        sort_cmd = f"(gunzip -c {input_file} | head -n 1 && gunzip -c {input_file} | tail -n +2 | sort -k2,2V -k3,3n -k8,8n) > {sorted_file}"
+    # Sort the body, keeping the header first; sort spills into the output folder.
+    # A presorted input (an earlier, wider output) only needs decompressing.
+    # The header is split off by the shell in the same pass, so the input is decompressed once.
+    quoted_input = shlex.quote(input_file)
+    sort_body = build_sort_cmd(os.path.dirname(output_gz_file) or '.', mapping)
+    header_then_sort = f"{{ IFS= read -r header; printf '%s\\n' \"$header\"; {sort_body}; }}"
+    if presorted:
+        sort_cmd = build_decompress_cmd(input_file)
+    elif input_file.endswith('.gz'):
+        sort_cmd = f"{build_decompress_cmd(input_file)} | {header_then_sort}"
     else:
-        sort_cmd = f"(head -n 1 {input_file} && tail -n +2 {input_file} | sort -k2,2V -k3,3n -k8,8n) > {sorted_file}"
+        sort_cmd = f"{header_then_sort} < {quoted_input}"
+    
+    # A presorted input is an earlier output, so statistics are labelled as
+    # coming from that source rather than from the original input
+    source = "source" if presorted else "input"
+    filter_cmd = (f"{AWK} -F'\\t' -v pcol={mapping['pval'] + 1} -v pmin={'' if pval_min is None else pval_min} "
+                  f"-v pmax={'' if pval_max is None else pval_max} -v source={source} {shlex.quote(PVAL_FILTER_AWK)}")
+    pipeline = f"set -o pipefail; {sort_cmd} | {filter_cmd} | bgzip -@ {os.cpu_count()} -c > {shlex.quote(output_gz_file)}"
     
     try:
-        subprocess.run(sort_cmd, shell=True, check=True)
-        sorted_size = os.path.getsize(sorted_file)
-        print(f"Sorted file size: {sorted_size} bytes")
+        subprocess.run(pipeline, shell=True, check=True, executable='/bin/bash')
     except subprocess.CalledProcessError as e:
-        print(f"Error during sorting: {e}")
+        print(f"Error during sort/filter/compress: {e}")
         raise
-
-    # Step 3: Filter the sorted file
-    print(f"Filtering data with p-value in range {pval_min} to {pval_max}...")
-    
-    with open(sorted_file, 'r') as sorted_fh, open(filtered_file, 'w') as filtered_fh:
-        header = sorted_fh.readline()
-        filtered_fh.write(header)
-        filtered_lines += 1  # Count header
-        
-        for line_num, line in enumerate(sorted_fh, 1):
-            total_lines += 1
-            fields = line.strip().split('\t')
-            try:
-                if len(fields) < 8:  # Verify we have enough fields
-                    print(f"Warning: Line {line_num} has only {len(fields)} fields")
-                    error_lines += 1
-                    continue
-                    
-                pval = float(fields[7])  # P-value is in column 8 (index 7)
-                
-                # Print some sample p-values for debugging
-                if line_num <= 5:
-                    print(f"Sample p-value at line {line_num}: {pval}")
-                
-                # Validate p-value is between 0 and 1
-                if not (0 <= pval <= 1):
-                    error_lines += 1
-                    if error_lines <= 5:
-                        print(f"Invalid p-value at line {line_num}: {pval}")
-                    continue
-                
-                if (pval_min is None or pval >= pval_min) and (pval_max is None or pval <= pval_max):
-                    filtered_fh.write(line)
-                    filtered_lines += 1
-                    
-            except (ValueError, IndexError) as e:
-                error_lines += 1
-                if error_lines <= 5:  # Only print first 5 errors
-                    print(f"Error at line {line_num}: {e}")
-                    print(f"Problematic line: {line[:100]}...")
     
-    print(f"\nFiltering Statistics:")
-    print(f"Total lines processed: {total_lines}")
-    print(f"Lines after filtering: {filtered_lines}")
-    print(f"Error lines: {error_lines}")
-    
-    # Rest of the function remains the same...
-    # Step 4: Compress with bgzip
-    output_gz_file = f"{output_file}.gz"
-    print(f"Compressing filtered file to {output_gz_file} using bgzip...")
-    subprocess.run(['bgzip', '-c', filtered_file], stdout=open(output_gz_file, 'wb'), check=True)
-    
-    # Create Tabix index
+    # Create a CSI Tabix index, which unlike .tbi supports positions beyond 2^29
     print(f"Creating Tabix index for {output_gz_file}...")
     try:
-        subprocess.run(['tabix', '-s', '2', '-b', '3', '-e', '3', '-S', '1', output_gz_file], check=True)
+        chr_col, pos_col = str(mapping['chr'] + 1), str(mapping['pos'] + 1)
+        subprocess.run(['tabix', '-C', '-s', chr_col, '-b', pos_col, '-e', pos_col, '-S', '1', output_gz_file],
+                       check=True)
     except subprocess.CalledProcessError as e:
         print(f"Error creating tabix index: {e}")
         raise
 
-    # Base64 encoding
-    print("Encoding files to base64...")
-    with open(output_gz_file, "rb") as f:
-        encoded_gz = base64.b64encode(f.read()).decode('utf-8')
-    with open(f"{output_gz_file}.tbi", "rb") as f:
-        encoded_tbi = base64.b64encode(f.read()).decode('utf-8')
+    # Optional base64 copies, streamed to sidecar files so outputs are never held in memory
+    encoded_gz = encoded_index = None
+    if base64_sidecars:
+        print("Encoding files to base64...")
+        encoded_gz = encode_base64_file(output_gz_file)
+        encoded_index = encode_base64_file(f"{output_gz_file}.csi")
 
     print(f"\nFinal file sizes:")
-    print(f"Original input: {os.path.getsize(input_file)} bytes")
-    print(f"Sorted file: {os.path.getsize(sorted_file)} bytes")
-    print(f"Filtered file: {os.path.getsize(filtered_file)} bytes")
+    print(f"{'Source' if presorted else 'Original input'}: {os.path.getsize(input_file)} bytes")
     print(f"Compressed output: {os.path.getsize(output_gz_file)} bytes")
-    print(f"Index file: {os.path.getsize(f'{output_gz_file}.tbi')} bytes")
+    print(f"Index file: {os.path.getsize(f'{output_gz_file}.csi')} bytes")
 
-    # Clean up temporary files
-    os.remove(sorted_file)
-    os.remove(filtered_file)
+    return encoded_gz, encoded_index
 
-    return encoded_gz, encoded_tbi
+def create_tabix_files(input_file, software_type, targets, base64_sidecars=False):
+    """Create a tabix file for each (output_file, pval_min, pval_max) target of input_file.
+
+    Only the widest range is sorted from the input. Each narrower range is
+    filtered from the smallest finished output whose range contains it, which
+    is already sorted and usually far smaller than the input.
+    """
+    # Order ranges so that any containing range is processed before those it contains
+    targets = sorted(targets, key=lambda target: (
+        float('-inf') if target[1] is None else target[1],
+        float('-inf') if target[2] is None else -target[2]))
+    
+    finished = []  # (pval_range, output_gz_file)
+    results = []
+    for output_file, pval_min, pval_max in targets:
+        sources = [gz_file for pval_range, gz_file in finished
+                   if pval_range_contains(pval_range, (pval_min, pval_max))]
+        if sources:
+            source = min(sources, key=os.path.getsize)
+            print(f"Deriving p-value range {pval_min} to {pval_max} from {source}...")
+            results.append(create_tabix_file(source, output_file, software_type, pval_min, pval_max,
+                                             presorted=True, base64_sidecars=base64_sidecars))
+        else:
+            results.append(create_tabix_file(input_file, output_file, software_type, pval_min, pval_max,
+                                             base64_sidecars=base64_sidecars))
+        finished.append(((pval_min, pval_max), f"{output_file}.gz"))
+    return results
 
 def main():
     # Set up argument parser
@@ -139,6 +189,8 @@ def main():
                         help='Specific phenotype to process (if not specified, processes all phenotypes)')
     parser.add_argument('-c', '--cohort',
                         help='Specific cohort to process (if not specified, processes all cohorts)')
+    parser.add_argument('--base64', action='store_true',
+                        help='Also write base64-encoded copies of each output and index (.b64 files)')
     
     args = parser.parse_args()
 
@@ -184,7 +236,8 @@ def main():
             phenotype = components[0]
             cohort = components[1]
             
-            # Process each p-value range
+            # Collect an output for each p-value range, then build them in one go
+            targets = []
             for pval_min, pval_max in pval_ranges:
                 if pval_max is None:
                     pval_range_str = f"{pval_min}_and_above"
@@ -199,8 +252,10 @@ def main():
                     f"{phenotype}.{cohort}.{software}_pval_{pval_range_str}"
                 )
                 
-                print(f"Processing {phenotype}-{cohort}-{software} for p-value range {pval_min} to {pval_max if pval_max else 'above'}...")
-                encoded_gz, encoded_tbi = create_tabix_file(input_file, output_file, pval_min, pval_max)
+                targets.append((output_file, pval_min, pval_max))
+            
+            print(f"Processing {phenotype}-{cohort}-{software} for p-value ranges {pval_ranges}...")
+            create_tabix_files(input_file, software, targets, base64_sidecars=args.base64)
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,26 @@
 # Second script: match_all_snps.py
+import io
 import os
-import gzip
 import json
 import glob
 import logging
+import sqlite3
 import argparse
+import multiprocessing
+from functools import partial
+from itertools import chain, groupby, repeat
+from operator import itemgetter
+
+try:
+    # ISA-L's SIMD deflate/inflate is API-compatible with the stdlib module and several times faster
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Column mappings (same as first script)
 COLUMN_MAPPINGS = {
@@ -20,6 +36,90 @@ COLUMN_MAPPINGS = {
     }
 }
 
+# Keys of each matched SNP's info, and the COLUMN_MAPPINGS column each comes from
+SNP_INFO_FIELDS = ('chromosome', 'position', 'ref_allele', 'alt_allele', 'beta',
+                   'se', 'p_value', 'aaf', 'n', 'n_study')
+SNP_INFO_COLUMNS = ('chr', 'pos', 'ref', 'alt', 'beta', 'se', 'pval', 'aaf', 'n', 'n_study')
+
+# Per software type: the id column followed by the SNP_INFO_COLUMNS indices, and
+# the number of fields a row needs to contain all of them
+COLUMN_INDICES = {
+    software: (mapping['id'], *(mapping[key] for key in SNP_INFO_COLUMNS))
+    for software, mapping in COLUMN_MAPPINGS.items()
+}
+MIN_FIELDS = {software: max(indices) + 1 for software, indices in COLUMN_INDICES.items()}
+
+def dump_json(obj):
+    """Serialize obj to compact JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def load_json(data):
+    """Parse JSON from bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def load_consolidated_ids(consolidated_dir, cache_file, software_type):
+    """Return the SNP IDs of the consolidated data for software_type as a frozenset of bytes.
+
+    The IDs are cached in cache_file, one per line after a header line that
+    records the name, size and mtime of each consolidated file; the cache is
+    used while that header still matches, and rebuilt otherwise.
+    """
+    pattern = os.path.join(consolidated_dir, f'consolidated_snp_data_{software_type}.*.ndjson.gz')
+    sources = []
+    for consolidated_file in sorted(glob.glob(pattern)):
+        stat = os.stat(consolidated_file)
+        sources.append([os.path.basename(consolidated_file), stat.st_size, stat.st_mtime_ns])
+    if not sources:
+        # Matching against no IDs would quietly write an empty result
+        raise FileNotFoundError(f"No consolidated SNP data files match {pattern}")
+    header = dump_json(sources)
+    
+    if os.path.exists(cache_file):
+        with gzip.open(cache_file, 'rb') as f:
+            cached_header, _, cached_ids = f.read().partition(b'\n')
+        if cached_header == header:
+            logging.info(f"Loaded consolidated SNP IDs from {cache_file}")
+            return frozenset(cached_ids.splitlines())
+    
+    # Per-chromosome files, one JSON record per line. Only membership is ever
+    # tested, so keep just the IDs, as bytes: that is what the tabix reader
+    # produces, and it saves decoding every row
+    consolidated_ids = set()
+    for name, _, _ in sources:
+        with gzip.open(os.path.join(consolidated_dir, name), 'rb') as f:
+            for line in f:
+                consolidated_ids.update(snp_id.encode() for snp_id in load_json(line))
+    id_set = frozenset(consolidated_ids)
+    del consolidated_ids
+    
+    # Write under a temporary name, so an interrupted run never leaves a truncated cache
+    with gzip.open(f'{cache_file}.tmp', 'wb', compresslevel=1) as f:
+        f.write(header + b'\n')
+        f.write(b'\n'.join(id_set))
+    os.replace(f'{cache_file}.tmp', cache_file)
+    return id_set
+
+def open_match_store(db_file):
+    """Create a scratch SQLite store of matched rows, one per (snp_id, phenotype, cohort).
+
+    Rows are clustered on that key (WITHOUT ROWID), so inserts sorted by SNP ID
+    and the export in SNP ID order both walk the table's B-tree sequentially.
+    """
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    # The store is rebuilt from scratch on every run, so durability is not needed
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute(f"CREATE TABLE matches (snp_id TEXT, phenotype TEXT, cohort TEXT, "
+                 f"{', '.join(f'{field} TEXT' for field in SNP_INFO_FIELDS)}, "
+                 f"PRIMARY KEY (snp_id, phenotype, cohort)) WITHOUT ROWID")
+    return conn
+
 def setup_logging(output_dir, software):
     log_file = os.path.join(output_dir, f'snp_matching_{software}.log')
     logging.basicConfig(
@@ -30,74 +130,94 @@ def setup_logging(output_dir, software):
         force=True  # Reset logging for each software type
     )
 
-def process_gz_file(file_path, original_snp_data, software_type):
-    snp_data = {}
-    matched_snps = set()
+def iter_line_blocks(f, block_size=1 << 20):
+    """Yield the lines of binary file f, without line endings, a block_size read at a time."""
+    tail = b''
+    while block := f.read(block_size):
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()  # partial last line, completed by the next block
+        yield lines
+    if tail:
+        yield [tail]
+
+# Consolidated SNP IDs, set once per pool worker by _init_worker
+_id_set = None
+
+def _init_worker(id_set):
+    global _id_set
+    _id_set = id_set
+
+def _worker(file_path, software_type):
+    """Match one tabix file in a pool worker, returning (file_path, result, error)."""
+    try:
+        return file_path, process_gz_file(file_path, _id_set, software_type), None
+    except Exception as e:
+        return file_path, None, str(e)
+
+def process_gz_file(file_path, id_set, software_type):
+    """Match one tabix file against the consolidated SNP IDs (a set of bytes).
+
+    Returns (phenotype, cohort, columns), where columns holds the matched rows
+    column-wise, sorted by SNP ID: the snp_id column followed by one column per
+    SNP_INFO_FIELDS.
+    """
+    rows = []
     
     filename = os.path.basename(file_path)
     phenotype = filename.split('.')[0]
     cohort = filename.split('.')[1]
     
-    mapping = COLUMN_MAPPINGS[software_type]
+    indices = COLUMN_INDICES[software_type]
+    id_idx = indices[0]
+    min_fields = MIN_FIELDS[software_type]
+    get_row = itemgetter(*indices)
     
-    with gzip.open(file_path, 'rt') as f:
-        next(f)
-        for line in f:
-            fields = line.strip().split('\t')
-            if len(fields) < max(mapping.values()) + 1:
+    # Split raw bytes into lines a 1 MiB block at a time, which is cheaper than
+    # reading them one by one; only matched rows are decoded
+    with gzip.open(file_path, 'rb') as f:
+        lines = chain.from_iterable(iter_line_blocks(f))
+        next(lines)
+        for line in lines:
+            # Most rows do not match, so test the ID column before splitting
+            # the whole row; when it leads the row, a slice is enough
+            if id_idx == 0:
+                snp_id = line[:line.find(b'\t')]
+            else:
+                leading = line.split(b'\t', id_idx + 1)
+                if len(leading) <= id_idx:
+                    continue
+                snp_id = leading[id_idx]
+            if snp_id not in id_set:
                 continue
             
-            try:
-                snp_id = fields[mapping['id']]
-                if snp_id not in original_snp_data:
-                    continue
-                
-                matched_snps.add(snp_id)
-                
-                snp_info = {
-                    'chromosome': fields[mapping['chr']],
-                    'position': fields[mapping['pos']],
-                    'ref_allele': fields[mapping['ref']],
-                    'alt_allele': fields[mapping['alt']],
-                    'beta': fields[mapping['beta']],
-                    'se': fields[mapping['se']],
-                    'p_value': fields[mapping['pval']],
-                    'aaf': fields[mapping['aaf']],
-                    'n': fields[mapping['n']],
-                    'n_study': fields[mapping['n_study']]
-                }
-                
-                if snp_id not in snp_data:
-                    snp_data[snp_id] = {}
-                
-                if phenotype not in snp_data[snp_id]:
-                    snp_data[snp_id][phenotype] = {}
-                
-                snp_data[snp_id][phenotype][cohort] = snp_info
-                
-            except (IndexError, ValueError) as e:
-                print(f"Error processing line in {file_path}: {str(e)}")
+            # Split no further than the last column that is kept
+            fields = line.decode().strip().split('\t', min_fields)
+            if len(fields) < min_fields:
                 continue
+            
+            rows.append(get_row(fields))
     
-    return snp_data, matched_snps
+    # Sort by SNP ID (stably, so duplicate rows keep their file order), so the
+    # parent inserts them into its store in key order
+    rows.sort(key=itemgetter(0))
+    # Transpose into columns, which are far cheaper to send back to the parent
+    # process than one nested dict per SNP
+    columns = tuple(zip(*rows)) or ((),) * (len(SNP_INFO_FIELDS) + 1)
+    return phenotype, cohort, columns
 
 def process_software_type(input_dir, consolidated_dir, output_dir, software_type):
     # Setup logging for this software type
     setup_logging(output_dir, software_type)
     logging.info(f"Starting processing for {software_type}")
 
-    # Load the original consolidated SNP data
-    consolidated_file = os.path.join(consolidated_dir, f'consolidated_snp_data_{software_type}.json.gz')
-    with gzip.open(consolidated_file, 'rt') as f:
-        original_snp_data = json.load(f)
-    
-    new_consolidated_data = {}
-    all_matched_snps = set()
+    # Load the consolidated SNP IDs, reusing the cached set from an earlier run when it is current
+    id_set = load_consolidated_ids(
+        consolidated_dir, os.path.join(output_dir, f'consolidated_snp_ids_{software_type}.txt.gz'), software_type)
 
     # Find relevant tabix files
     pattern = os.path.join(input_dir, f"*.{software_type}_pval_*.gz")
     gz_files = glob.glob(pattern)
-    gz_files = [f for f in gz_files if not f.endswith('.tbi')]
+    gz_files = [f for f in gz_files if not f.endswith(('.tbi', '.csi'))]
 
     if not gz_files:
         print(f"No tabix files found for {software_type}")
@@ -105,34 +225,58 @@ def process_software_type(input_dir, consolidated_dir, output_dir, software_type
 
     print(f"\nProcessing {software_type} files...")
     total_files = len(gz_files)
-    for index, file_path in enumerate(gz_files, 1):
-        print(f"Processing file {index}/{total_files}: {os.path.basename(file_path)}")
-        try:
-            file_data, matched_snps = process_gz_file(file_path, original_snp_data, software_type)
-            all_matched_snps.update(matched_snps)
+    # Files are matched in parallel; the consolidated data is handed to each
+    # worker once through the initializer rather than pickled with every task.
+    # Results are merged in input order, as before, so that duplicate SNP rows
+    # resolve the same way regardless of which worker finishes first.
+    # Matches go straight to an on-disk store, committed per file, so the
+    # parent never holds more than one file's results in memory
+    db_file = os.path.join(output_dir, f'matched_snp_data_{software_type}.sqlite')
+    conn = open_match_store(db_file)
+    insert = f"INSERT OR REPLACE INTO matches VALUES ({', '.join('?' * (len(SNP_INFO_FIELDS) + 3))})"
+    with multiprocessing.Pool(processes=os.cpu_count(), initializer=_init_worker,
+                              initargs=(id_set,)) as pool:
+        results = pool.imap(partial(_worker, software_type=software_type), gz_files, chunksize=4)
+        for index, (file_path, result, error) in enumerate(results, 1):
+            print(f"Processed file {index}/{total_files}: {os.path.basename(file_path)}")
+            if error is not None:
+                error_msg = f"Error processing {file_path}: {error}"
+                print(error_msg)
+                logging.error(error_msg)
+                continue
+            
+            phenotype, cohort, (snp_ids, *info_columns) = result
             
-            for snp_id, snp_info in file_data.items():
-                if snp_id not in new_consolidated_data:
-                    new_consolidated_data[snp_id] = {}
-                new_consolidated_data[snp_id].update(snp_info)
+            # Merge down to the cohort level, so results for the same phenotype
+            # from different cohort files do not overwrite each other
+            conn.executemany(insert, zip(snp_ids, repeat(phenotype), repeat(cohort), *info_columns))
+            conn.commit()
             
             logging.info(f"File: {os.path.basename(file_path)}")
-            logging.info(f"Matched SNPs in this file: {len(matched_snps)}")
+            logging.info(f"Matched SNPs in this file: {len(set(snp_ids))}")
             logging.info("--------------------")
-        except Exception as e:
-            error_msg = f"Error processing {file_path}: {str(e)}"
-            print(error_msg)
-            logging.error(error_msg)
 
-    # Save matched data
+    # Export the store as one JSON object, walking it in snp_id order so each
+    # SNP's entry is built and encoded on its own
+    total_matched, = conn.execute('SELECT COUNT(DISTINCT snp_id) FROM matches').fetchone()
     output_file = os.path.join(output_dir, f'matched_snp_data_{software_type}.json.gz')
-    with gzip.open(output_file, 'wt') as f:
-        json.dump(new_consolidated_data, f)
+    with io.BufferedWriter(gzip.open(output_file, 'wb', compresslevel=1), buffer_size=1 << 20) as f:
+        separator = b'{'
+        rows = conn.execute('SELECT * FROM matches ORDER BY snp_id, phenotype, cohort')
+        for snp_id, snp_rows in groupby(rows, key=itemgetter(0)):
+            snp_entry = {}
+            for _, phenotype, cohort, *values in snp_rows:
+                snp_entry.setdefault(phenotype, {})[cohort] = dict(zip(SNP_INFO_FIELDS, values))
+            f.write(b'%s%s:%s' % (separator, dump_json(snp_id), dump_json(snp_entry)))
+            separator = b','
+        f.write(b'}' if total_matched else b'{}')
+    conn.close()
+    os.remove(db_file)
 
     print(f"{software_type} data saved to {output_file}")
-    print(f"Total matched SNPs for {software_type}: {len(all_matched_snps)}")
+    print(f"Total matched SNPs for {software_type}: {total_matched}")
     
-    logging.info(f"Total matched SNPs for {software_type}: {len(all_matched_snps)}")
+    logging.info(f"Total matched SNPs for {software_type}: {total_matched}")
     logging.info("Processing completed")
 
 def main():